@@ -0,0 +1,289 @@
+# batch_agent.py
+"""
+Bulk (offline) insight and MCQ generation through the OpenAI Batch API.
+Batch requests cost ~50% less than interactive calls and complete within 24h.
+Every submitted job is recorded under BATCH_DIR/jobs until its results are
+appended to results.jsonl, so polling resumes after a crash or restart and
+work that is finished or still in flight is never submitted (and paid for) twice.
+"""
+
+import json
+import logging
+import tempfile
+import threading
+import time
+from pathlib import Path
+from config import client
+from qa_agent import (
+    extract_text_from_pdf, _file_digest, _clip_to_tokens,
+    _insights_messages, _mcq_messages, _mcq_response_format
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_DIR = Path(tempfile.gettempdir()) / "batch_jobs"
+JOBS_DIR = BATCH_DIR / "jobs"
+RESULTS_PATH = BATCH_DIR / "results.jsonl"
+POLL_INTERVAL = 30  # seconds
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+_results_lock = threading.Lock()
+_polling = set()
+_polling_lock = threading.Lock()
+
+# -------------------------------------------------------------------
+# 🔹 Checkpoint: finished results & submitted-but-unfinished jobs
+# -------------------------------------------------------------------
+def _custom_id(digest, model, task):
+    # Content hash + model + task, so a revised file or another model is new work.
+    return f"{digest}::{model}::{task}"
+
+
+def _completed_ids(results_path=RESULTS_PATH):
+    done = set()
+    if not Path(results_path).exists():
+        return done
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["custom_id"])
+            except (ValueError, KeyError):
+                continue  # partial line from an interrupted write
+    return done
+
+
+def _job_path(batch_id):
+    return JOBS_DIR / f"{batch_id}.json"
+
+
+def _load_job(batch_id):
+    with open(_job_path(batch_id), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_job(batch_id, job):
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = _job_path(batch_id).with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f)
+    tmp_path.replace(_job_path(batch_id))
+
+
+def _save_job(batch_id, requests_meta):
+    _write_job(batch_id, {"batch_id": batch_id, "requests": requests_meta, "status": "submitted"})
+
+
+def _record_status(batch_id, status):
+    job = _load_job(batch_id)
+    if job.get("status") != status:
+        job["status"] = status
+        _write_job(batch_id, job)
+
+
+def job_status(batch_id):
+    """Last status the background poller saw for a pending job (no API call)."""
+    try:
+        return _load_job(batch_id).get("status", "submitted")
+    except (OSError, ValueError):
+        return "unknown"
+
+
+def list_pending_jobs():
+    """Batch ids that were submitted but whose results are not yet written."""
+    if not JOBS_DIR.exists():
+        return []
+    return sorted(path.stem for path in JOBS_DIR.glob("*.json"))
+
+
+def _reserve(requests_meta):
+    """Marks requests as in flight before they are sent, so no failure after the batch
+    is created can lead to them being submitted (and paid for) again.
+
+    Deleting a leftover .pending file releases its requests.
+    """
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    path = JOBS_DIR / f"reserved_{time.time_ns()}.pending"
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"requests": requests_meta}, f)
+    return path
+
+
+def _in_flight_ids():
+    in_flight = set()
+    if not JOBS_DIR.exists():
+        return in_flight
+    for path in [*JOBS_DIR.glob("*.json"), *JOBS_DIR.glob("*.pending")]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                in_flight.update(json.load(f)["requests"])
+        except (OSError, ValueError, KeyError):
+            continue
+    return in_flight
+
+# -------------------------------------------------------------------
+# 1️⃣ Build Batch Requests
+# -------------------------------------------------------------------
+def build_batch_requests(file_paths, model="gpt-4o-mini", num_questions=10, results_path=RESULTS_PATH):
+    """Returns (requests, meta): one /v1/chat/completions request per (file, task) still to do.
+
+    meta maps each custom_id to the file, digest, model and task it belongs to.
+    """
+    skip = _completed_ids(results_path) | _in_flight_ids()
+    requests, meta = [], {}
+    for file_path in file_paths:
+        digest = _file_digest(file_path)
+        tasks = {
+            "insights": _custom_id(digest, model, "insights"),
+            f"mcq{num_questions}": _custom_id(digest, model, f"mcq{num_questions}"),
+        }
+        pending = {task: cid for task, cid in tasks.items() if cid not in skip and cid not in meta}
+        if not pending:
+            continue
+
+        text = extract_text_from_pdf(file_path)
+        if not text:
+            continue
+
+        # Clip rather than condense: the map step would otherwise run as full-price
+        # interactive calls before anything reached the batch.
+        document = _clip_to_tokens(text, model)
+        for task, custom_id in pending.items():
+            if task == "insights":
+                body = {"model": model, "messages": _insights_messages(document), "temperature": 0.4}
+            else:
+                body = {
+                    "model": model,
+                    "messages": _mcq_messages(document, num_questions),
+                    "temperature": 0.5,
+                    "response_format": _mcq_response_format(model),
+                }
+            requests.append({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            })
+            meta[custom_id] = {"file": Path(file_path).name, "digest": digest, "model": model, "task": task}
+    return requests, meta
+
+# -------------------------------------------------------------------
+# 2️⃣ Submit & Poll
+# -------------------------------------------------------------------
+def submit_batch(requests):
+    """Uploads the requests as a JSONL file and creates a batch job.
+
+    Returns the batch id, or a "[Batch submission error: ...]" message.
+    """
+    try:
+        BATCH_DIR.mkdir(parents=True, exist_ok=True)
+        input_path = BATCH_DIR / f"batch_input_{int(time.time())}.jsonl"
+        with open(input_path, "w", encoding="utf-8") as f:
+            for request in requests:
+                f.write(json.dumps(request) + "\n")
+
+        with open(input_path, "rb") as f:
+            batch_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+    except Exception as e:
+        return f"[Batch submission error: {e}]"
+
+
+def _write_results(batch_id, output, results_path):
+    requests_meta = _load_job(batch_id)["requests"]
+    with _results_lock:
+        done = _completed_ids(results_path)
+        with open(results_path, "a", encoding="utf-8") as f:
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["custom_id"] in done:
+                    continue
+                body = (record.get("response") or {}).get("body", {})
+                choices = body.get("choices") or [{}]
+                f.write(json.dumps({
+                    "custom_id": record["custom_id"],
+                    **requests_meta.get(record["custom_id"], {}),
+                    "content": choices[0].get("message", {}).get("content"),
+                    "error": record.get("error"),
+                }) + "\n")
+
+
+def _poll_batch(batch_id, results_path=RESULTS_PATH, interval=POLL_INTERVAL):
+    try:
+        while True:
+            try:
+                batch = client.batches.retrieve(batch_id)
+                _record_status(batch_id, batch.status)
+                if batch.status in TERMINAL_STATUSES:
+                    if batch.output_file_id:
+                        output = client.files.content(batch.output_file_id).text
+                        _write_results(batch_id, output, results_path)
+                    else:
+                        logger.warning("Batch %s ended as %s without output", batch_id, batch.status)
+                    _job_path(batch_id).unlink(missing_ok=True)
+                    return
+            except Exception:
+                # Transient API/network failure: the job stays on disk, so just try again.
+                logger.exception("Polling batch %s failed; retrying in %ss", batch_id, interval)
+            time.sleep(interval)
+    finally:
+        with _polling_lock:
+            _polling.discard(batch_id)
+
+
+def _start_polling(batch_id):
+    with _polling_lock:
+        if batch_id in _polling:
+            return
+        _polling.add(batch_id)
+    threading.Thread(target=_poll_batch, args=(batch_id,), daemon=True).start()
+
+
+def resume_pending_jobs():
+    """Restarts polling for recorded jobs, e.g. after a server restart. Safe to call every rerun."""
+    for batch_id in list_pending_jobs():
+        _start_polling(batch_id)
+
+
+def start_batch_job(file_paths, model="gpt-4o-mini", num_questions=10):
+    """Submits pending work for file_paths and polls it in a background thread.
+
+    Returns the batch id, None when every request is already done or in flight,
+    or a "[Batch submission error: ...]" message.
+    """
+    try:
+        requests, meta = build_batch_requests(file_paths, model=model, num_questions=num_questions)
+        if not requests:
+            return None
+        reservation = _reserve(meta)
+    except Exception as e:
+        return f"[Batch submission error: {e}]"
+
+    batch_id = submit_batch(requests)
+    if batch_id.startswith("[Batch submission error"):
+        reservation.unlink(missing_ok=True)  # no batch was created: release the requests
+        return batch_id
+
+    try:
+        _save_job(batch_id, meta)
+    except Exception:
+        # The batch is live but cannot be polled; the reservation keeps it from being resubmitted.
+        logger.exception("Batch %s was submitted but not recorded; its requests stay reserved in %s", batch_id, reservation)
+        return f"[Batch submission error: batch {batch_id} was submitted but could not be recorded]"
+    reservation.unlink(missing_ok=True)
+
+    _start_polling(batch_id)
+    return batch_id
+
+
+def batch_status(batch_id):
+    try:
+        return client.batches.retrieve(batch_id).status
+    except Exception as e:
+        return f"[Batch status error: {e}]"
@@ -1,11 +1,24 @@
 import os
+import httpx
 from dotenv import load_dotenv
+from openai import OpenAI
 
-# Load environment variables
-load_dotenv()
+# Load environment variables (skip parsing .env when the key is already set)
+if not os.environ.get("OPENAI_API_KEY"):
+    load_dotenv()
 
 # Get OpenAI API key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 if not OPENAI_API_KEY:
     raise ValueError("OpenAI API key not found in environment variables")
+
+# Shared OpenAI client over one keep-alive HTTP/2 pool for the whole process:
+# modules stay imported across Streamlit reruns, so repeat calls skip the TCP/TLS handshake.
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=40)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)  # SDK default read timeout; long generations need it
+
+http_client = httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+# Keeps the SDK's default retries for callers without their own policy (batch_agent);
+# qa_agent derives a max_retries=0 copy because tenacity retries its calls.
+client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
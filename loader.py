@@ -1,8 +1,42 @@
 from PyPDF2 import PdfReader
 
+try:
+    import pypdfium2 as pdfium  # PDFium (C++) backend, ~10x faster than PyPDF2
+except ImportError:
+    pdfium = None
+
 def load_pdf(file_path):
     reader = PdfReader(file_path)
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text()
-    return text
+    return "".join(page.extract_text() or "" for page in reader.pages)
+
+def page_count(file_path):
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    return len(PdfReader(file_path).pages)
+
+# Kept in this lightweight module because it runs in spawned worker processes,
+# which import only the module that defines it.
+def extract_page_range(file_path, start, stop):
+    """Opens its own document and extracts pages [start, stop)."""
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            pages = []
+            for i in range(start, stop):
+                # Release each page as soon as its text is copied out, so resident
+                # memory stays at roughly one decoded page plus the output text.
+                page = pdf[i]
+                textpage = page.get_textpage()
+                pages.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            return "\n".join(pages)
+        finally:
+            pdf.close()
+
+    reader = PdfReader(file_path)
+    return "\n".join(reader.pages[i].extract_text() or "" for i in range(start, stop))
@@ -6,133 +6,801 @@ using OpenAI GPT models.
 """
 
 import os
+import re
+import json
+import asyncio
+import hashlib
+import shutil
+import tempfile
+import threading
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from PyPDF2 import PdfReader
-from dotenv import load_dotenv
-from openai import OpenAI
+import diskcache
+import httpx
+import tiktoken
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from config import OPENAI_API_KEY, HTTP_LIMITS, HTTP_TIMEOUT, client
+from loader import pdfium, page_count, extract_page_range
+from rag_pipeline import build_rag_from_texts, save_rag, load_rag
 
 # -------------------------------------------------------------------
-# 🔹 Load environment variables and initialize client
+# 🔹 Shared client (environment and key validation live in config.py)
 # -------------------------------------------------------------------
-load_dotenv()  # Loads .env file from project root
-api_key = os.getenv("OPENAI_API_KEY")
+# Same connection pool as config.client, but retries come from _retry_on_rate_limit
+# only: stacking the SDK's own under it would multiply the requests for one failure.
+_llm_client = client.with_options(max_retries=0)
 
-if not api_key:
-    raise ValueError("❌ OPENAI_API_KEY not found in .env file. Please set it properly.")
 
-client = OpenAI(api_key=api_key)
+def _async_client():
+    """AsyncOpenAI with the same pool settings, for use inside a single event loop."""
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT),
+        max_retries=0  # retries come from _retry_on_rate_limit only
+    )
+
+# -------------------------------------------------------------------
+# 🔹 Utility: Rate-limit backoff & bounded concurrency
+# -------------------------------------------------------------------
+MAX_CONCURRENT_REQUESTS = 5
+_backoff = wait_random_exponential(min=1, max=30)
+_request_slots = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+
+
+def _wait_for_rate_limit(retry_state):
+    """Honours the server's Retry-After header (1-60 s), else random exponential backoff."""
+    error = retry_state.outcome.exception()
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(max(float(retry_after), 1.0), 60.0)
+    except (TypeError, ValueError):
+        return _backoff(retry_state)
+
+
+def _is_retryable(error):
+    # The clients are built with max_retries=0, so this also covers the 5xx and
+    # connection failures the SDK used to retry; timeouts are not retried.
+    if isinstance(error, openai.APITimeoutError):
+        return False
+    return isinstance(error, (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError))
+
+
+_retry_on_rate_limit = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_wait_for_rate_limit,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+
+
+def _slots():
+    # A semaphore belongs to one event loop, and run_all/_condense each start a new one.
+    loop = asyncio.get_running_loop()
+    if loop not in _request_slots:
+        _request_slots[loop] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _request_slots[loop]
+
+
+@_retry_on_rate_limit
+def _create_completion(**kwargs):
+    return _llm_client.chat.completions.create(**kwargs)
+
+
+@_retry_on_rate_limit
+async def _a_create_completion(aclient, **kwargs):
+    return await aclient.chat.completions.create(**kwargs)
+
+# -------------------------------------------------------------------
+# 🔹 Utility: Chat completions memoized on (model, temperature, prompt)
+# -------------------------------------------------------------------
+llm_cache = diskcache.Cache(str(Path(tempfile.gettempdir()) / "llm_cache"))
+LLM_CACHE_TTL = 24 * 60 * 60  # seconds
+
+
+def _cache_key(messages, model, temperature, **kwargs):
+    payload = json.dumps([model, temperature, messages, kwargs], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _chat(messages, model, temperature, **kwargs):
+    """Returns the reply text, reusing a cached reply for an identical request."""
+    key = _cache_key(messages, model, temperature, **kwargs)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    response = _create_completion(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        **kwargs
+    )
+    content = response.choices[0].message.content
+    llm_cache.set(key, content, expire=LLM_CACHE_TTL)
+    return content
+
+
+async def _a_chat(aclient, messages, model, temperature, **kwargs):
+    """Async counterpart of _chat sharing the same cache."""
+    key = _cache_key(messages, model, temperature, **kwargs)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async with _slots():
+        response = await _a_create_completion(
+            aclient,
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **kwargs
+        )
+    content = response.choices[0].message.content
+    llm_cache.set(key, content, expire=LLM_CACHE_TTL)
+    return content
+
+
+def _stream_chat(messages, model, temperature, error_label):
+    """Yields content deltas as they arrive so the UI can render before the reply completes."""
+    key = _cache_key(messages, model, temperature)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    try:
+        stream = _create_completion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True
+        )
+        parts = []
+        for chunk in stream:
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content or ""
+                parts.append(delta)
+                yield delta
+        llm_cache.set(key, "".join(parts), expire=LLM_CACHE_TTL)
+    except Exception as e:
+        yield f"[{error_label} error: {e}]"
 
 # -------------------------------------------------------------------
-# 🔹 Utility: Extract text from PDF
+# 🔹 Utility: Extract text from PDF (cached per file content)
 # -------------------------------------------------------------------
+PDF_CACHE_DIR = Path(tempfile.gettempdir()) / "pdfcache"
+
+
+@lru_cache(maxsize=128)
+def _hash_file(file_path, mtime_ns, size) -> str:
+    # mtime_ns and size are only part of the cache key: a rewritten file is hashed again.
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_digest(file_path) -> str:
+    """SHA-256 of the file bytes, used as the extraction and index cache key.
+
+    Memoized on (path, mtime, size), so repeat calls for an unchanged file only stat it.
+    """
+    stat = os.stat(file_path)
+    return _hash_file(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+
+
+# PyPDF2 runs at ~1 s/page, so fanning pages out pays off past a few pages. PDFium
+# extracts in milliseconds per page, where process dispatch plus re-opening the
+# PDF in every worker costs more than it saves, so it always runs in-process.
+PARALLEL_PAGE_THRESHOLD = 4
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool():
+    """One long-lived pool of spawned (not forked) extraction workers.
+
+    Forking the multi-threaded Streamlit server can copy a lock held by another
+    thread into the child and deadlock it; spawned workers start clean and only
+    import loader. Keeping the pool alive pays the spawn cost once per process.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pdf_pool
+
+
+def _read_pdf_text(file_path) -> str:
+    file_path = str(file_path)
+    num_pages = page_count(file_path)
+    if pdfium is not None or num_pages <= PARALLEL_PAGE_THRESHOLD:
+        return extract_page_range(file_path, 0, num_pages).strip()
+
+    # One contiguous page range per worker so each process parses the xref once.
+    workers = min(os.cpu_count() or 1, num_pages)
+    step = -(-num_pages // workers)
+    starts = list(range(0, num_pages, step))
+    stops = [min(start + step, num_pages) for start in starts]
+    parts = _get_pdf_pool().map(extract_page_range, [file_path] * len(starts), starts, stops)
+    return "\n".join(parts).strip()
+
+
+@lru_cache(maxsize=32)
+def _extract_text_cached(digest: str, file_path: str) -> str:
+    # Disk copy survives Streamlit reruns and process restarts.
+    cache_file = PDF_CACHE_DIR / f"{digest}.txt"
+    if cache_file.exists():
+        return cache_file.read_text(encoding="utf-8")
+
+    text = _read_pdf_text(file_path)
+    PDF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_file.write_text(text, encoding="utf-8")
+    return text
+
+
 def extract_text_from_pdf(file_path: str) -> str:
-    """Extracts all text from a PDF file."""
+    """Extracts all text from a PDF file, parsing each distinct file only once."""
     try:
-        reader = PdfReader(file_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text.strip()
+        return _extract_text_cached(_file_digest(file_path), str(file_path))
     except Exception as e:
         return f"[Error extracting text: {e}]"
 
+# -------------------------------------------------------------------
+# 🔹 Utility: Sliding-window token chunking & map-reduce condensing
+# -------------------------------------------------------------------
+CHUNK_TOKENS = 3000   # K: tokens per window
+CHUNK_STRIDE = 2250   # S: window start offset (0.75 * K, so windows overlap by 25%)
+
+
+@lru_cache(maxsize=8)
+def _encoding_for(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+# Input budget = context window - room for the reply - system/instruction overhead.
+MODEL_CONTEXT_TOKENS = {"gpt-4o-mini": 128000, "gpt-4o": 128000, "gpt-3.5-turbo": 16385}
+MAX_COMPLETION_TOKENS = 4096
+SYSTEM_OVERHEAD_TOKENS = 512
+
+
+def _input_token_budget(model):
+    context = MODEL_CONTEXT_TOKENS.get(model, min(MODEL_CONTEXT_TOKENS.values()))
+    return context - MAX_COMPLETION_TOKENS - SYSTEM_OVERHEAD_TOKENS
+
+
+def _clip_to_tokens(text, model, budget=None):
+    """Truncates text to an exact token budget for model (default: its input budget)."""
+    budget = _input_token_budget(model) if budget is None else budget
+    enc = _encoding_for(model)
+    ids = enc.encode(text)
+    if len(ids) <= budget:
+        return text
+    return enc.decode(ids[:budget])
+
+
+def chunk_tokens(text, model="gpt-4o-mini", K=CHUNK_TOKENS, S=CHUNK_STRIDE):
+    """Splits text into overlapping token windows C_i = t[(i-1)S : min((i-1)S + K, N)]."""
+    enc = _encoding_for(model)
+    ids = enc.encode(text)
+    chunks = []
+    for start in range(0, len(ids), S):
+        chunks.append(enc.decode(ids[start:start + K]))
+        if start + K >= len(ids):
+            break
+    return chunks
+
+
+async def _a_condense_chunks(aclient, chunks, model):
+    async def condense(chunk):
+        messages = [
+            {"role": "system", "content": "You condense excerpts of a longer financial or technical document into dense notes, keeping every figure, date, name and notable claim."},
+            {"role": "user", "content": chunk}
+        ]
+        return (await _a_chat(aclient, messages, model, 0)).strip()
+
+    return await asyncio.gather(*(condense(chunk) for chunk in chunks))
+
+
+async def _a_condense(text, model, aclient=None):
+    """Returns the document itself if it fits the model's input budget, else per-window notes (map step).
+
+    The notes are shared by summary, insights and MCQs, which each act as the reduce step,
+    and are kept in llm_cache so sync and async callers reuse one map pass.
+    """
+    if len(_encoding_for(model).encode(text)) <= _input_token_budget(model):
+        return text  # the model sees the real text in a single request
+
+    key = "condense:" + hashlib.sha256(f"{model}|{text}".encode("utf-8")).hexdigest()
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    chunks = chunk_tokens(text, model)
+    if aclient is None:
+        async with _async_client() as own_client:
+            notes = await _a_condense_chunks(own_client, chunks, model)
+    else:
+        notes = await _a_condense_chunks(aclient, chunks, model)
+
+    condensed = "\n\n".join(f"[Part {i}]\n{note}" for i, note in enumerate(notes, 1))
+    llm_cache.set(key, condensed, expire=LLM_CACHE_TTL)
+    return condensed
+
+
+def _condense(text, model):
+    """Sync wrapper around _a_condense; must not be called from a running event loop."""
+    return asyncio.run(_a_condense(text, model))
+
+
+def _prompt_document(text, model):
+    """The document as sent to the prompts: the text itself if it fits, else the notes clipped to budget."""
+    return _clip_to_tokens(_condense(text, model), model)
+
+
+async def _a_prompt_document(text, model, aclient):
+    return _clip_to_tokens(await _a_condense(text, model, aclient), model)
+
+
+def prepare_document(file_path, model="gpt-4o-mini"):
+    """Runs extraction and the map step up front so the UI can show progress for them.
+
+    Both are cached, so the generators called afterwards start streaming immediately.
+    Returns an error message, or None on success.
+    """
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        return None
+    try:
+        _condense(text, model)
+    except Exception as e:
+        return f"[Document preparation error: {e}]"
+    return None
+
+# -------------------------------------------------------------------
+# 🔹 Utility: Cache-friendly document prompts
+# -------------------------------------------------------------------
+# Every document task sends the same system message and the same document
+# message first, with the task instruction last. OpenAI caches identical
+# prompt prefixes (>= 1024 tokens), so summary, insights, MCQs and
+# generate_all on one document reuse the cached system + document prefix.
+ANALYST_SYSTEM_PROMPT = (
+    "You are an expert financial analyst and teacher. You summarize documents, "
+    "identify trends, risks, opportunities and anomalies, and write concept-checking "
+    "multiple choice questions. Follow the instruction given after the document."
+)
+
+
+def _document_messages(document, instruction):
+    return [
+        {"role": "system", "content": ANALYST_SYSTEM_PROMPT},
+        {"role": "user", "content": f"DOCUMENT:\n{document}"},
+        {"role": "user", "content": f"INSTRUCTION: {instruction}"}
+    ]
+
 # -------------------------------------------------------------------
 # 1️⃣ Generate Summary
 # -------------------------------------------------------------------
+def _summary_messages(document):
+    return _document_messages(document, "Summarize this financial or technical document in bullet points.")
+
+
 def generate_summary(file_path, model="gpt-4o-mini", temperature=0.3):
     text = extract_text_from_pdf(file_path)
     if not text:
         return "No text extracted from the document."
 
-    prompt = f"Summarize this financial or technical document in bullet points:\n\n{text[:6000]}"
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are an expert financial data summarizer."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=temperature
-        )
-        return response.choices[0].message.content.strip()
+        return _chat(_summary_messages(_prompt_document(text, model)), model, temperature).strip()
+    except Exception as e:
+        return f"[Summary generation error: {e}]"
+
+
+def generate_summary_stream(file_path, model="gpt-4o-mini", temperature=0.3):
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        yield "No text extracted from the document."
+        return
+    try:
+        messages = _summary_messages(_prompt_document(text, model))
+    except Exception as e:
+        yield f"[Summary generation error: {e}]"
+        return
+    yield from _stream_chat(messages, model, temperature, "Summary generation")
+
+
+async def a_generate_summary(aclient, file_path, model="gpt-4o-mini", temperature=0.3):
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        return "No text extracted from the document."
+
+    try:
+        return (await _a_chat(aclient, _summary_messages(await _a_prompt_document(text, model, aclient)), model, temperature)).strip()
     except Exception as e:
         return f"[Summary generation error: {e}]"
 
 # -------------------------------------------------------------------
 # 2️⃣ Generate Insights
 # -------------------------------------------------------------------
+def _insights_messages(document):
+    return _document_messages(document, "From this financial document, derive deep insights, patterns, and anomalies.")
+
+
 def generate_insights(file_path, model="gpt-4o-mini", chunk_size=1024):
     text = extract_text_from_pdf(file_path)
     if not text:
         return "No text extracted."
 
-    prompt = f"From the following financial document, derive deep insights, patterns, and anomalies:\n\n{text[:8000]}"
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are a financial analyst who identifies trends, risks, and opportunities."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.4
-        )
-        return response.choices[0].message.content.strip()
+        return _chat(_insights_messages(_prompt_document(text, model)), model, 0.4).strip()
+    except Exception as e:
+        return f"[Insight generation error: {e}]"
+
+
+def generate_insights_stream(file_path, model="gpt-4o-mini"):
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        yield "No text extracted."
+        return
+    try:
+        messages = _insights_messages(_prompt_document(text, model))
+    except Exception as e:
+        yield f"[Insight generation error: {e}]"
+        return
+    yield from _stream_chat(messages, model, 0.4, "Insight generation")
+
+
+async def a_generate_insights(aclient, file_path, model="gpt-4o-mini"):
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        return "No text extracted."
+
+    try:
+        return (await _a_chat(aclient, _insights_messages(await _a_prompt_document(text, model, aclient)), model, 0.4)).strip()
     except Exception as e:
         return f"[Insight generation error: {e}]"
 
 # -------------------------------------------------------------------
 # 3️⃣ Generate MCQs
 # -------------------------------------------------------------------
+# Compact keys keep the JSON short; strict json_schema guarantees it parses.
+MCQ_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "q": {"type": "string"},
+        "options": {"type": "array", "items": {"type": "string"}},
+        "answer": {"type": "string"}
+    },
+    "required": ["q", "options", "answer"],
+    "additionalProperties": False
+}
+MCQ_JSON_SCHEMA = {
+    "name": "mcqs",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"mcqs": {"type": "array", "items": MCQ_ITEM_SCHEMA}},
+        "required": ["mcqs"],
+        "additionalProperties": False
+    }
+}
+STRUCTURED_OUTPUT_MODELS = {"gpt-4o-mini", "gpt-4o"}
+
+
+def _json_response_format(model, json_schema):
+    # Older models only support JSON mode; the instruction spells out the same shape.
+    if model in STRUCTURED_OUTPUT_MODELS:
+        return {"type": "json_schema", "json_schema": json_schema}
+    return {"type": "json_object"}
+
+
+def _mcq_response_format(model):
+    return _json_response_format(model, MCQ_JSON_SCHEMA)
+
+
+def _mcq_messages(document, num_questions):
+    instruction = (
+        f"Generate {num_questions} concise multiple choice questions with exactly 4 short options each. "
+        'Return JSON of the form {"mcqs": [{"q": question, "options": [4 options], "answer": correct option}]}.'
+    )
+    return _document_messages(document, instruction)
+
+
+def _is_valid_mcq(item):
+    # The schema cannot pin the option count, so check it and that the answer is a choice.
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get("q"), str)
+        and isinstance(item.get("options"), list)
+        and len(item["options"]) == 4
+        and item.get("answer") in item["options"]
+    )
+
+
+def format_mcq(item):
+    """Renders one {"q", "options", "answer"} MCQ as editable plain text."""
+    options = "\n".join(f"{label}) {option}" for label, option in zip("ABCD", item["options"]))
+    return f"{item['q']}\n{options}\nAnswer: {item['answer']}"
+
+
+def _format_mcqs(items):
+    """Formats the well-formed MCQs, skipping any without exactly 4 options or with an answer outside them."""
+    return [format_mcq(item) for item in items if _is_valid_mcq(item)]
+
+
+def _parse_mcqs(content):
+    items = json.loads(content)["mcqs"]
+    mcqs = _format_mcqs(items)
+    if items and not mcqs:
+        raise ValueError("none of the returned questions had 4 options including the answer")
+    return mcqs
+
+
 def generate_mcq(file_path, num_questions=5, model="gpt-4o-mini"):
+    """Returns a list of formatted MCQ strings (a one-item list with a message on failure)."""
     text = extract_text_from_pdf(file_path)
     if not text:
-        return "No text extracted."
+        return ["No text extracted."]
 
-    prompt = (
-        f"Generate {num_questions} multiple choice questions with 4 options each, "
-        "and provide the correct answer at the end. Use this document:\n\n"
-        f"{text[:8000]}"
-    )
+    try:
+        messages = _mcq_messages(_prompt_document(text, model), num_questions)
+        return _parse_mcqs(_chat(messages, model, 0.5, response_format=_mcq_response_format(model)))
+    except Exception as e:
+        return [f"[MCQ generation error: {e}]"]
+
+
+async def a_generate_mcq(aclient, file_path, num_questions=5, model="gpt-4o-mini"):
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        return ["No text extracted."]
 
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are a teacher creating concept-checking MCQs."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5
-        )
-        return response.choices[0].message.content.strip()
+        messages = _mcq_messages(await _a_prompt_document(text, model, aclient), num_questions)
+        content = await _a_chat(aclient, messages, model, 0.5, response_format=_mcq_response_format(model))
+        return _parse_mcqs(content)
     except Exception as e:
-        return f"[MCQ generation error: {e}]"
+        return [f"[MCQ generation error: {e}]"]
 
 # -------------------------------------------------------------------
-# 4️⃣ Answer Question
+# 4️⃣ Answer Question (top-k retrieval)
 # -------------------------------------------------------------------
-def answer_question(file_path, question, model="gpt-4o-mini"):
+RETRIEVAL_K = 4
+
+# Questions about the file itself are answered locally, without an LLM call. The
+# patterns must match the whole question, so content questions ("how many pages
+# does the risk section span?", "name of the document's author") reach the model.
+_DOC = r"(the|this) (file|document|pdf|report)"
+_WHAT_IS = r"(what is |what's )?(the )?(total )?"
+_END = r"\s*\??\s*$"
+# Optional: a bare "how many pages?" is about the document too.
+_COUNT_TAIL = rf"( (are there|does ({_DOC}|it)( have| contain)?|(are )?(there )?in {_DOC}|is {_DOC}))?"
+_PAGE_COUNT_RE = re.compile(
+    rf"^\s*(how many pages{_COUNT_TAIL}"
+    rf"|{_WHAT_IS}(page count|number of pages)( (of|in) {_DOC})?){_END}",
+    re.IGNORECASE
+)
+_WORD_COUNT_RE = re.compile(
+    rf"^\s*(how many words{_COUNT_TAIL}"
+    rf"|{_WHAT_IS}(word count|number of words)( (of|in) {_DOC})?){_END}",
+    re.IGNORECASE
+)
+_FILE_NAME_RE = re.compile(rf"^\s*{_WHAT_IS}(file ?name|name of {_DOC}){_END}", re.IGNORECASE)
+_FILE_SIZE_RE = re.compile(
+    rf"^\s*({_WHAT_IS}(file size|size of {_DOC})|how (big|large) is {_DOC}){_END}",
+    re.IGNORECASE
+)
+
+
+# (question, rule expected to answer it or None) - run `python qa_agent.py` to check.
+_METADATA_QUESTION_CASES = [
+    ("how many pages?", _PAGE_COUNT_RE),
+    ("How many pages are there?", _PAGE_COUNT_RE),
+    ("How many pages is the report?", _PAGE_COUNT_RE),
+    ("how many pages does the document have?", _PAGE_COUNT_RE),
+    ("What is the page count?", _PAGE_COUNT_RE),
+    ("total word count?", _WORD_COUNT_RE),
+    ("what's the total number of words in the document?", _WORD_COUNT_RE),
+    ("how many words does the report contain?", _WORD_COUNT_RE),
+    ("what is the file name?", _FILE_NAME_RE),
+    ("how big is the file?", _FILE_SIZE_RE),
+    ("how many pages does the risk section span?", None),
+    ("how many words are in the conclusion?", None),
+    ("what is the word count limit for abstracts?", None),
+    ("name of the document's author", None),
+]
+
+
+def _check_metadata_rules():
+    rules = [_PAGE_COUNT_RE, _WORD_COUNT_RE, _FILE_NAME_RE, _FILE_SIZE_RE]
+    for question, expected in _METADATA_QUESTION_CASES:
+        matched = next((rule for rule in rules if rule.search(question)), None)
+        assert matched is expected, f"{question!r} matched {matched and matched.pattern!r}"
+
+
+def _answer_without_llm(file_path, question, text):
+    """Returns a computed answer for trivial metadata questions, or None to fall through."""
+    if _PAGE_COUNT_RE.search(question):
+        return f"The document has {page_count(str(file_path))} pages."
+    if _WORD_COUNT_RE.search(question):
+        return f"The document contains about {len(text.split()):,} words."
+    if _FILE_NAME_RE.search(question):
+        return f"The file name is `{Path(file_path).name}`."
+    if _FILE_SIZE_RE.search(question):
+        return f"The file is {Path(file_path).stat().st_size / 1024:,.1f} KB."
+    return None
+
+
+def answer_question(file_path, question, model="gpt-4o-mini", chunk_size=1024):
     text = extract_text_from_pdf(file_path)
     if not text:
         return "No text available to answer from."
 
-    prompt = f"Use the following document to answer the question:\n\nDocument:\n{text[:6000]}\n\nQuestion: {question}"
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are an expert assistant that answers accurately from context."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2
-        )
-        return response.choices[0].message.content.strip()
+        direct_answer = _answer_without_llm(file_path, question, text)
+        if direct_answer is not None:
+            return direct_answer
+
+        vector_store, _ = _get_index(_file_digest(file_path), str(file_path), chunk_size)
+        docs = vector_store.similarity_search(question, k=RETRIEVAL_K)
+        context = _clip_to_tokens("\n\n".join(doc.page_content for doc in docs), model)
+
+        prompt = f"Use the following document excerpts to answer the question:\n\nDocument:\n{context}\n\nQuestion: {question}"
+        messages = [
+            {"role": "system", "content": "You are an expert assistant that answers accurately from context."},
+            {"role": "user", "content": prompt}
+        ]
+        return _chat(messages, model, 0.2).strip()
     except Exception as e:
         return f"[Answer generation error: {e}]"
 
 # -------------------------------------------------------------------
-# 5️⃣ Dummy Build Retrieval Index
+# 5️⃣ Build Retrieval Index (FAISS, persisted per file hash)
 # -------------------------------------------------------------------
-def build_retrieval_index(file_path, chunk_size=1024):
-    """Placeholder RAG index builder (for UI only)."""
+# load_local unpickles the docstore, so indexes live in a per-user 0700 directory
+# rather than the shared, world-writable temp dir.
+INDEX_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "rag_document_analyzer" / "faiss_index"
+
+
+def _private_index_dir():
+    INDEX_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(INDEX_DIR, 0o700)
+    return INDEX_DIR
+
+
+def _build_index(file_path, index_path, chunk_size):
     text = extract_text_from_pdf(file_path)
-    return f"✅ Indexed document '{Path(file_path).name}' with {len(text)//chunk_size + 1} chunks."
+    chunks = chunk_tokens(text, K=chunk_size, S=max(1, chunk_size * 3 // 4))
+    vector_store = build_rag_from_texts(chunks)
+
+    # Write to a sibling temp folder and swap it in, so a crash never leaves a
+    # half-written index under the final name.
+    tmp_path = index_path.with_name(f"{index_path.name}.tmp-{os.getpid()}-{threading.get_ident()}")
+    save_rag(vector_store, tmp_path)
+    shutil.rmtree(index_path, ignore_errors=True)
+    tmp_path.rename(index_path)
+    return vector_store, len(chunks)
+
+
+@lru_cache(maxsize=8)
+def _get_index(digest, file_path, chunk_size):
+    """Loads the FAISS index for this file content and chunk size, building it on first use."""
+    index_path = _private_index_dir() / f"{digest}_{chunk_size}"
+    if index_path.exists():
+        try:
+            vector_store = load_rag(index_path)
+            return vector_store, vector_store.index.ntotal
+        except Exception:
+            pass  # unreadable index: rebuild it below
+    return _build_index(file_path, index_path, chunk_size)
+
+
+def build_retrieval_index(file_path, chunk_size=1024, rebuild=False):
+    """Builds (or reuses) the FAISS index that answer_question retrieves from.
+
+    rebuild=True discards any saved index for this file and chunk size first.
+    """
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        return "No text extracted."
+
+    try:
+        digest, chunk_size = _file_digest(file_path), int(chunk_size)
+        if rebuild:
+            _build_index(str(file_path), _private_index_dir() / f"{digest}_{chunk_size}", chunk_size)
+            _get_index.cache_clear()
+        _, num_chunks = _get_index(digest, str(file_path), chunk_size)
+        return f"✅ Indexed document '{Path(file_path).name}' with {num_chunks} chunks."
+    except Exception as e:
+        return f"[Index build error: {e}]"
+
+# -------------------------------------------------------------------
+# 6️⃣ Generate Summary, Insights & MCQs in One Request
+# -------------------------------------------------------------------
+ANALYSIS_JSON_SCHEMA = {
+    "name": "analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"},
+            "insights": {"type": "string"},
+            "mcqs": {"type": "array", "items": MCQ_ITEM_SCHEMA}
+        },
+        "required": ["summary", "insights", "mcqs"],
+        "additionalProperties": False
+    }
+}
+
+
+def generate_all(file_path, num_mcqs=10, model="gpt-4o-mini", temperature=0.3):
+    """Runs all three analyses in a single chat call, sending the document once."""
+    text = extract_text_from_pdf(file_path)
+    if not text:
+        return {"summary": "No text extracted from the document.", "insights": "", "mcqs": []}
+
+    instruction = (
+        "Return a JSON object with keys 'summary' (bullet-point summary as a string), "
+        "'insights' (deep insights, patterns, and anomalies as a string) and 'mcqs' "
+        f"(a list of {num_mcqs} concise multiple choice questions, each of the form "
+        '{"q": question, "options": [4 short options], "answer": correct option}).'
+    )
+    try:
+        messages = _document_messages(_prompt_document(text, model), instruction)
+        content = _chat(messages, model, temperature, response_format=_json_response_format(model, ANALYSIS_JSON_SCHEMA))
+        result = json.loads(content)
+        return {
+            "summary": str(result.get("summary", "")).strip(),
+            "insights": str(result.get("insights", "")).strip(),
+            "mcqs": _format_mcqs(result.get("mcqs", [])),
+        }
+    except Exception as e:
+        return {"summary": f"[Analysis error: {e}]", "insights": "", "mcqs": []}
+
+# -------------------------------------------------------------------
+# 7️⃣ Run Summary, Insights & MCQs Concurrently
+# -------------------------------------------------------------------
+async def _gather_all(file_path, model, temperature, num_questions):
+    # A fresh async client per event loop: asyncio.run() closes its loop on exit,
+    # and pooled connections must not outlive the loop that opened them.
+    async with _async_client() as aclient:
+        text = extract_text_from_pdf(file_path)
+        if text:
+            # Run the shared map step once before the three tasks would each start it.
+            await _a_condense(text, model, aclient)
+        return await asyncio.gather(
+            a_generate_summary(aclient, file_path, model=model, temperature=temperature),
+            a_generate_insights(aclient, file_path, model=model),
+            a_generate_mcq(aclient, file_path, num_questions=num_questions, model=model),
+        )
+
+
+def run_all(file_path, model="gpt-4o-mini", temperature=0.3, num_questions=10):
+    """Issues the summary, insights and MCQ requests in parallel.
+
+    Returns a ``(summary, insights, mcqs)`` tuple; mcqs is a list of strings.
+    """
+    try:
+        summary, insights, mcqs = asyncio.run(_gather_all(file_path, model, temperature, num_questions))
+    except Exception as e:
+        error = f"[Analysis error: {e}]"
+        return error, error, [error]
+    return summary, insights, mcqs
+
+
+if __name__ == "__main__":
+    _check_metadata_rules()
+    print(f"{len(_METADATA_QUESTION_CASES)} metadata question cases OK")
@@ -1,21 +1,80 @@
+import uuid
+import faiss
+import numpy as np
 from langchain.chat_models import ChatOpenAI
 from langchain.vectorstores import FAISS
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.document_loaders import PyPDFLoader
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
 from langchain.schema import HumanMessage, SystemMessage
 from config import OPENAI_API_KEY
 
 embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
 
+# Inputs per embeddings request; the API accepts up to 2048, so N chunks cost
+# ceil(N / EMBED_BATCH_SIZE) round trips instead of N.
+EMBED_BATCH_SIZE = 256
+
+# IVF-PQ: 64 coarse clusters, 16 sub-quantizers x 8 bits = 16 bytes per vector
+# (vs 6 KB for a float32 1536-d vector). Training wants ~39 points per centroid
+# for both the 64 coarse clusters and each sub-quantizer's 2^8 = 256-entry
+# codebook, so collections under 256 * 39 vectors keep an exact flat index.
+IVF_NLIST = 64
+IVF_NPROBE = 8
+PQ_M = 16
+PQ_NBITS = 8
+IVF_MIN_VECTORS = max(IVF_NLIST, 2 ** PQ_NBITS) * 39
+
 def load_pdf(file_path):
     loader = PyPDFLoader(file_path)
     return loader.load()
 
+def embed_texts(texts, batch_size=EMBED_BATCH_SIZE):
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        vectors.extend(embeddings.embed_documents(texts[start:start + batch_size]))
+    return vectors
+
+def build_faiss_index(vectors):
+    vectors = np.asarray(vectors, dtype="float32")
+    dim = vectors.shape[1]
+    if len(vectors) < IVF_MIN_VECTORS or dim % PQ_M:
+        index = faiss.IndexFlatL2(dim)
+    else:
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, IVF_NLIST, PQ_M, PQ_NBITS)
+        index.train(vectors)
+        index.nprobe = IVF_NPROBE
+    index.add(vectors)
+    return index
+
+def build_vector_store(texts, vectors, metadatas=None):
+    index = build_faiss_index(vectors)
+    metadatas = metadatas or [{} for _ in texts]
+    ids = [str(uuid.uuid4()) for _ in texts]
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=metadata)
+        for doc_id, text, metadata in zip(ids, texts, metadatas)
+    })
+    return FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+
 def build_rag(documents):
-    vector_store = FAISS.from_documents(documents, embeddings)
+    texts = [doc.page_content for doc in documents]
+    vector_store = build_vector_store(texts, embed_texts(texts), [doc.metadata for doc in documents])
     return vector_store
 
+def build_rag_from_texts(texts):
+    return build_vector_store(texts, embed_texts(texts))
+
+def save_rag(vector_store, folder_path):
+    # Writes the index with faiss.write_index, so IVF-PQ codes and nprobe persist as-is.
+    vector_store.save_local(str(folder_path))
+
+def load_rag(folder_path):
+    # Unpickles the docstore: only pass a directory that no other user can write to.
+    return FAISS.load_local(str(folder_path), embeddings, allow_dangerous_deserialization=True)
+
 def get_agent_response(vector_store, prompt):
     llm = ChatOpenAI(openai_api_key=OPENAI_API_KEY, temperature=0)
     docs = vector_store.similarity_search(prompt, k=3)
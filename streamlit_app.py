@@ -5,8 +5,12 @@
 import streamlit as st
 from pathlib import Path
 import tempfile
+import shutil
 import base64
-from qa_agent import generate_summary, generate_insights, generate_mcq, answer_question, build_retrieval_index
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from batch_agent import start_batch_job, job_status, list_pending_jobs, resume_pending_jobs, RESULTS_PATH
+from qa_agent import prepare_document, generate_summary_stream, generate_insights_stream, generate_mcq, generate_all, run_all, answer_question, build_retrieval_index
 
 # -------------------------- Page Config --------------------------
 st.set_page_config(
@@ -16,12 +20,35 @@ st.set_page_config(
 )
 
 # -------------------------- Helper Utilities --------------------------
+PREVIEW_ROWS = 50
+
 def save_uploaded_file(uploaded_file, dst_path: Path):
     dst_path.parent.mkdir(parents=True, exist_ok=True)
+    uploaded_file.seek(0)
     with open(dst_path, "wb") as f:
-        f.write(uploaded_file.read())
+        shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
+    if dst_path.suffix.lower() == ".csv":
+        convert_csv_to_parquet(dst_path)
     return dst_path
 
+def convert_csv_to_parquet(csv_path: Path):
+    """Writes a columnar copy next to the CSV so previews read one row group, not the text file.
+
+    Converts batch by batch, so memory stays bounded however large the CSV is.
+    """
+    parquet_path = csv_path.with_suffix(".parquet")
+    try:
+        reader = pa_csv.open_csv(csv_path)
+        with pq.ParquetWriter(parquet_path, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+    except Exception:
+        parquet_path.unlink(missing_ok=True)  # preview falls back to raw bytes
+
+def preview_parquet(parquet_path: Path, rows: int = PREVIEW_ROWS):
+    batch = next(pq.ParquetFile(parquet_path).iter_batches(batch_size=rows), None)
+    return batch.to_pandas().to_string() if batch is not None else ""
+
 def make_download_link(text: str, filename: str):
     b64 = base64.b64encode(text.encode("utf-8")).decode()
     return f"data:file/txt;base64,{b64}"
@@ -35,6 +62,8 @@ with st.sidebar:
 
     temp = st.slider("Response Temperature", 0.0, 1.0, 0.3, 0.05)
     chunk_size = st.number_input("Document Chunk Size (tokens)", 256, 4096, 1024, 64)
+    single_request = st.checkbox("Combine 'Run All' into one request", value=True,
+                                 help="Unchecked, the three analyses run as parallel requests instead.")
     reindex = st.button("🔄 Rebuild Document Index")
 
     st.markdown("---")
@@ -43,6 +72,23 @@ with st.sidebar:
     st.markdown("- Rebuild the index after uploading.")
     st.markdown("- Use tabs to summarize, chat, or generate MCQs.")
 
+    st.markdown("---")
+    st.markdown("**📦 Bulk Process (Batch API, ~50% cheaper, up to 24h)**")
+    bulk_files = st.file_uploader("Upload PDFs for insights & MCQs", type=["pdf"], accept_multiple_files=True, key="bulk_files")
+    resume_pending_jobs()  # picks up jobs submitted before a restart
+    if st.button("📦 Bulk Process") and bulk_files:
+        bulk_dir = Path(tempfile.gettempdir()) / "uploaded_document" / "bulk"
+        # One folder per upload so files sharing a basename don't overwrite each other.
+        paths = [str(save_uploaded_file(f, bulk_dir / f.file_id / f.name)) for f in bulk_files]
+        batch_result = start_batch_job(paths, model=model)
+        if batch_result is None:
+            st.info("All files already have results or are being processed.")
+        elif batch_result.startswith("[Batch submission error"):
+            st.error(batch_result)
+    for batch_id in list_pending_jobs():
+        st.caption(f"Batch `{batch_id}`: {job_status(batch_id)}")  # read from disk, no API call
+    st.caption(f"Results: `{RESULTS_PATH}`")
+
 # -------------------------- Header --------------------------
 col1, col2 = st.columns([8, 2])
 with col1:
@@ -63,7 +109,10 @@ if uploaded_file:
     tmp = Path(tempfile.gettempdir()) / "uploaded_document"
     tmp.mkdir(parents=True, exist_ok=True)
     dst = tmp / uploaded_file.name
-    save_uploaded_file(uploaded_file, dst)
+    # Every rerun sees the same upload; only write (and convert) it the first time.
+    if st.session_state.get("upload_id") != uploaded_file.file_id or not dst.exists():
+        save_uploaded_file(uploaded_file, dst)
+        st.session_state.upload_id = uploaded_file.file_id
     st.session_state.uploaded_path = str(dst)
     st.success(f"✅ File uploaded: `{uploaded_file.name}`")
 
@@ -81,12 +130,15 @@ with tabs[0]:
 
         with st.expander("📝 Show Raw Text Preview (First 8000 Characters)"):
             try:
-                with open(st.session_state.uploaded_path, "rb") as f:
-                    _b = f.read()
+                parquet_path = Path(st.session_state.uploaded_path).with_suffix(".parquet")
                 if file_name.endswith(".pdf"):
                     st.info("PDF text will be extracted during processing.")
+                elif file_name.endswith(".csv") and parquet_path.exists():
+                    st.text(preview_parquet(parquet_path)[:8000])
                 else:
-                    st.text(_b[:8000].decode(errors="replace"))
+                    with open(st.session_state.uploaded_path, "rb") as f:
+                        _b = f.read(8000)
+                    st.text(_b.decode(errors="replace"))
             except Exception:
                 st.error("❌ Unable to preview this file type.")
     else:
@@ -101,30 +153,58 @@ with tabs[1]:
         c1, c2, c3 = st.columns(3)
         with c1:
             if st.button("📄 Create Summary"):
-                with st.spinner("Summarizing..."):
-                    summary = generate_summary(st.session_state.uploaded_path, model=model, temperature=temp)
+                with st.spinner("Reading document..."):
+                    error = prepare_document(st.session_state.uploaded_path, model=model)
+                if error:
+                    st.error(error)
+                else:
+                    summary = st.write_stream(
+                        generate_summary_stream(st.session_state.uploaded_path, model=model, temperature=temp)
+                    )
                     st.session_state.last_summary = summary
                     st.success("✅ Summary Generated")
-                    st.write(summary)
         with c2:
             if st.button("💡 Extract Insights"):
-                with st.spinner("Extracting insights..."):
-                    insights = generate_insights(st.session_state.uploaded_path, model=model, chunk_size=chunk_size)
+                with st.spinner("Reading document..."):
+                    error = prepare_document(st.session_state.uploaded_path, model=model)
+                if error:
+                    st.error(error)
+                else:
+                    insights = st.write_stream(
+                        generate_insights_stream(st.session_state.uploaded_path, model=model)
+                    )
                     st.session_state.last_insights = insights
                     st.success("✅ Insights Ready")
-                    st.write(insights)
         with c3:
             if st.button("🎓 Create MCQs"):
                 with st.spinner("Generating MCQs..."):
-                    mcqs = generate_mcq(st.session_state.uploaded_path, num_questions=10, model=model)
-                    st.session_state.last_mcqs = mcqs.split("\n\n")
+                    st.session_state.last_mcqs = generate_mcq(st.session_state.uploaded_path, num_questions=10, model=model)
                     st.success("✅ MCQs Ready")
                     for i, q in enumerate(st.session_state.last_mcqs):
                         st.markdown(f"**Q{i+1}:** {q}")
 
+        if st.button("⚡ Run All Analyses"):
+            with st.spinner("Generating summary, insights & MCQs..."):
+                if single_request:
+                    results = generate_all(st.session_state.uploaded_path, num_mcqs=10, model=model, temperature=temp)
+                else:
+                    summary, insights, mcqs = run_all(st.session_state.uploaded_path, model=model, temperature=temp)
+                    results = {"summary": summary, "insights": insights, "mcqs": mcqs}
+                st.session_state.last_summary = results["summary"]
+                st.session_state.last_insights = results["insights"]
+                st.session_state.last_mcqs = results["mcqs"]
+                st.success("✅ Analysis Complete")
+                st.markdown("#### Summary")
+                st.write(results["summary"])
+                st.markdown("#### Insights")
+                st.write(results["insights"])
+                st.markdown("#### MCQs")
+                for i, q in enumerate(results["mcqs"]):
+                    st.markdown(f"**Q{i+1}:** {q}")
+
         if reindex:
             with st.spinner("Rebuilding document index..."):
-                result = build_retrieval_index(st.session_state.uploaded_path, chunk_size=chunk_size)
+                result = build_retrieval_index(st.session_state.uploaded_path, chunk_size=chunk_size, rebuild=True)
                 st.success(result)
 
 # -------------------------- Chat Tab --------------------------
@@ -140,7 +220,7 @@ with tabs[2]:
         if st.button("💬 Ask"):
             if query:
                 with st.spinner("Thinking..."):
-                    answer = answer_question(st.session_state.uploaded_path, query, model=model)
+                    answer = answer_question(st.session_state.uploaded_path, query, model=model, chunk_size=int(chunk_size))
                     st.session_state.chat_history.append({"q": query, "a": answer})
         if st.button("🧹 Clear Chat"):
             st.session_state.chat_history = []